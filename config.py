@@ -8,6 +8,7 @@ def parse_arguments(argv):
     parser.add_argument('--resume', type=str, default='', metavar='PATH')
     parser.add_argument('--checkpoint_dir', type=str, default='checkpoints')
     parser.add_argument('--log_dir', type=str, default='runs')
+    parser.add_argument('--cache_dir', type=str, default='cache')
     parser.add_argument('--msg', type=str, default='trainlog')
     parser.add_argument('--print_freq', type=int, default=100)
     parser.add_argument('--start_epoch', type=int, default=0)
@@ -37,6 +38,10 @@ def parse_arguments(argv):
     # loss weights (for combining with instance contrast)
     parser.add_argument('--inst_weight', type=int, default=1) # NOT USED YET
     parser.add_argument('--workers', type=int, default=48)
+    # mixed precision (autocast + GradScaler)
+    parser.add_argument('--amp', default=False, action='store_true')
+    # torch.compile the pixel propagation module (requires PyTorch >= 2.0)
+    parser.add_argument('--compile', default=False, action='store_true')
     
     ##### Encoder + Projection
     # temperature
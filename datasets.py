@@ -2,9 +2,94 @@ from torch.utils.data import Dataset
 from transforms import *
 import os
 import cv2
+import hashlib
+from typing import NamedTuple
 
 from utils import draw_for_debug
 
+# keep OpenCV single-threaded inside each DataLoader worker
+cv2.setNumThreads(0)
+
+def worker_init_fn(worker_id):
+    # the setting is per process, so apply it again in every (re)started worker
+    cv2.setNumThreads(0)
+
+class PixProBatch(NamedTuple):
+    """
+    Flat batch of tensors, so pin_memory reaches every field
+    params : crop rect and flip flag of each view [x, y, w, h, flip]
+    """
+    img1: torch.Tensor
+    img2: torch.Tensor
+    params1: torch.Tensor
+    params2: torch.Tensor
+
+    def pin_memory(self):
+        return PixProBatch(*(t.pin_memory() for t in self))
+
+def warp_affine_batch(params, size=7):
+    """
+    Get warped matrices (make 7x7 position matrix for every sample)
+    params : (B, 5) crop rect and flip flag [x, y, w, h, flip]
+    return : (B, size*size, 2) positions (x, y) in original image space
+    """
+    x, y, w, h, flip = params.unbind(1)
+    b = params.shape[0]
+    
+    t = torch.linspace(0, 1, size, device=params.device)
+    # If image is fliped, x runs from x+w down to x (flip folded into the linspace)
+    x_start = x + w * flip
+    x_step = w * (1 - 2*flip)
+    
+    xs = x_start.unsqueeze(1) + x_step.unsqueeze(1) * t  # B * size (columns)
+    ys = y.unsqueeze(1) + h.unsqueeze(1) * t             # B * size (rows)
+    
+    matrix = torch.stack([xs.unsqueeze(1).expand(b, size, size),
+                          ys.unsqueeze(2).expand(b, size, size)], dim=-1)
+    return matrix.view(b, size*size, 2)
+
+def compute_A_batch(params_base, params_moment, threshold, size=7):
+    """
+    Get A matrices on the device of params
+    params_base : (B, 5) base rect's position and flip flag
+    params_moment : (B, 5) moment rect's position and flip flag
+    threshold : distance threshold, normalized by base rect's diagonal length
+    return : (B, size*size, size*size)
+    """
+    base = warp_affine_batch(params_base, size)
+    moment = warp_affine_batch(params_moment, size)
+    
+    diff = base.unsqueeze(2) - moment.unsqueeze(1)
+    dist2_matrix = (diff*diff).sum(-1)
+    
+    w, h = params_base[:, 2], params_base[:, 3]
+    diag_len = torch.sqrt(w*w + h*h) / (size*size)
+    thr2 = (threshold * diag_len)**2
+    return (dist2_matrix < thr2.view(-1, 1, 1)).float()
+
+def compute_inter_mask_batch(params_base, params_moment, size=7):
+    """
+    Get intersection masks (positions located in the intersection of the two rects)
+    params_base : (B, 5) base rect's position and flip flag
+    params_moment : (B, 5) moment rect's position and flip flag
+    return : base mask, moment mask, each (B, size*size)
+    """
+    x1, y1, w1, h1, _ = params_base.unbind(1)
+    x2, y2, w2, h2, _ = params_moment.unbind(1)
+    
+    ix1, iy1 = torch.max(x1, x2), torch.max(y1, y2)
+    ix2, iy2 = torch.min(x1+w1, x2+w2), torch.min(y1+h1, y2+h2)
+    has_intersection = (ix1 < ix2) & (iy1 < iy2)
+    
+    masks = []
+    for params in (params_base, params_moment):
+        p = warp_affine_batch(params, size)
+        inter_mask = ((p[:,:,0] >= ix1.unsqueeze(1)) & (p[:,:,0] <= ix2.unsqueeze(1))
+                      & (p[:,:,1] >= iy1.unsqueeze(1)) & (p[:,:,1] <= iy2.unsqueeze(1))
+                      & has_intersection.unsqueeze(1))
+        masks.append(inter_mask.float())
+    return masks[0], masks[1]
+
 class PixProDataset(Dataset):
     def __init__(self, root, args, data_size=(224,224)):
         self.root = root
@@ -12,18 +97,20 @@ class PixProDataset(Dataset):
         self.args = args
 
         self.classes, self.class_to_idx = self._find_classes(self.root)
-        self.samples = self._make_dataset(self.root, self.class_to_idx)
-        self.targets = [s[1] for s in self.samples] 
-        
-        self.transform = transforms.Compose([
-            transforms.RandomApply([
-                transforms.ColorJitter(0.8, 0.8, 0.8, 0.2)],
-                p=0.8),
-            transforms.RandomGrayscale(p=0.2),
-            GaussianBlur(prob=0.3, mag=3),
-            Solarize(prob=0.3, mag=0.5),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        # paths are one utf-8 blob + offset table, all memory-mapped (see _load_samples)
+        self.paths, self.offsets, self.targets = self._load_samples(self.root, self.class_to_idx)
+        
+        # crop / flip are stateless, so one instance is shared by both views
+        self._crop = RandomResizedCrop(self.data_size)
+        self._flip = RandomHorizontalFlip(p=0.5)
+        
+        # crop / flip are applied beforehand since the A matrix depends on them.
+        # The rest runs on uint8 arrays, followed by fast_normalize.
+        self.transform = A.Compose([
+            A.ColorJitter(0.8, 0.8, 0.8, 0.2, p=0.8),
+            A.ToGray(p=0.2),
+            A.GaussianBlur(blur_limit=0, sigma_limit=(3, 3), p=0.3),
+            A.Solarize(threshold=128, p=0.3),
         ])
 
     def _find_classes(self, dir):
@@ -32,176 +119,112 @@ class PixProDataset(Dataset):
         class_to_idx = {cls_name: i for i, cls_name in enumerate(classes)}
         return classes, class_to_idx
 
+    def _load_samples(self, directory, class_to_idx):
+        """
+        Load the sample list from the cache, or scan the directory and cache it
+        cache is keyed by directory path + mtime, and stored as .npy files
+        paths : uint8 blob of all encoded paths
+        offsets : int64 (N+1), path i is paths[offsets[i]:offsets[i+1]]
+        targets : int32 (N)
+        """
+        directory = os.path.abspath(os.path.expanduser(directory))
+        key = '{}_{}'.format(directory, os.stat(directory).st_mtime_ns)
+        prefix = os.path.join(self.args.cache_dir, 'samples_{}'.format(hashlib.md5(key.encode()).hexdigest()))
+        names = ('paths', 'offsets', 'targets')
+        cache_paths = ['{}_{}.npy'.format(prefix, name) for name in names]
+        
+        # targets is written last, so if it exists the others do too
+        if not os.path.exists(cache_paths[-1]):
+            instances = self._make_dataset(directory, class_to_idx)
+            
+            encoded = [os.fsencode(path) for path, _ in instances]
+            offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(e) for e in encoded])
+            paths = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            targets = np.array([target for _, target in instances], dtype=np.int32)
+            
+            # write then rename, since several DDP processes may build the cache at once
+            os.makedirs(self.args.cache_dir, exist_ok=True)
+            for cache_path, array in zip(cache_paths, (paths, offsets, targets)):
+                tmp_path = '{}.{}.tmp.npy'.format(cache_path[:-len('.npy')], os.getpid())
+                np.save(tmp_path, array)
+                os.replace(tmp_path, cache_path)
+        
+        # mmap: pages are shared between processes / workers instead of copied per process
+        return tuple(np.load(cache_path, mmap_mode='r') for cache_path in cache_paths)
+
+    def _get_path(self, index):
+        start, end = self.offsets[index], self.offsets[index+1]
+        return os.fsdecode(self.paths[start:end].tobytes())
+
     def _make_dataset(self, directory, class_to_idx):
         instances = []
         directory = os.path.expanduser(directory)
         
-        for target_class in sorted(class_to_idx.keys()):
+        for target_class in sorted(class_to_idx):
             class_index = class_to_idx[target_class]
             target_dir = os.path.join(directory, target_class)
             if not os.path.isdir(target_dir):
                 continue
-            for root, _, fnames in sorted(os.walk(target_dir, followlinks=True)):
-                for fname in sorted(fnames):
-                    path = os.path.join(root, fname)
-                    item = path, class_index
-                    instances.append(item)
+            
+            # walk the class directory with scandir, then sort once
+            fpaths = []
+            dirs = [target_dir]
+            while dirs:
+                with os.scandir(dirs.pop()) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            dirs.append(entry.path)
+                        elif entry.is_file():
+                            fpaths.append(entry.path)
+            fpaths.sort()
+            instances.extend((path, class_index) for path in fpaths)
 
         return instances
     
     def _load_image(self, path):
-        with open(path, 'rb') as f:
-            img = Image.open(f)
-            return img.convert('RGB')
+        # OpenCV decodes JPEG through libjpeg-turbo
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        # imread returns None instead of raising on missing / corrupt files
+        if img is None:
+            raise IOError('cannot read image file: {}'.format(path))
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
     def __getitem__(self, index):
-        path, target = self.samples[index]
+        path = self._get_path(index)
         sample = self._load_image(path)
 
-        sample1, x1, y1, w1, h1 = RandomResizedCrop(self.data_size)(sample)
-        sample1, is_flip1 = RandomHorizontalFlip(p=0.5)(sample1)
-        sample1 = self.transform(sample1)
-
-        sample2, x2, y2, w2, h2 = RandomResizedCrop(self.data_size)(sample)
-        sample2, is_flip2 = RandomHorizontalFlip(p=0.5)(sample2)
-        sample2 = self.transform(sample2)
-        
-        # To make the A matrix
-        p_base = torch.FloatTensor(np.array([x1, y1, w1, h1]))
-        p_moment = torch.FloatTensor(np.array([x2, y2, w2, h2]))
-        f_base = torch.FloatTensor(np.array([is_flip1]))
-        f_moment = torch.FloatTensor(np.array([is_flip2]))
-        
-        # Position matrix
-        base_matrix = self._warp_affine(p_base)     
-        moment_matrix = self._warp_affine(p_moment) 
-        
-        # If image is fliped, have to flip position matrix
-        if f_base.item() > 0:
-            base_matrix = torch.fliplr(base_matrix)
-        if f_moment.item() > 0:
-            moment_matrix = torch.fliplr(moment_matrix)
-        
-        # Get normalized distance matrix (positive, negative pair)
-        base_A_matrix = self._get_A_matrix(base_matrix, moment_matrix, p_base) 
-        moment_A_matrix = self._get_A_matrix(moment_matrix, base_matrix, p_moment)
-        
-        # If the loss function is pixpro, just use feautres, A_matrix.
-        # However, if the loss function is pixcontrast, we use featreus, A_matrix, intersection mask
-        if self.args.loss == 'pixpro':
-            return (sample1, sample2), (base_A_matrix, moment_A_matrix)
-        
-        else:
-            inter_rect = self._get_intersection_rect((x1, y1, w1, h1), (x2, y2, w2, h2))
-
-            base_inter_mask = self._get_intersection_mask(base_matrix, inter_rect)
-            moment_inter_mask = self._get_intersection_mask(moment_matrix, inter_rect)
-            
-            return (sample1, sample2), ((base_A_matrix, moment_A_matrix), (base_inter_mask, moment_inter_mask))
-    
-    def _warp_affine(self, p, size=7):
-        """
-        Get warped matrix (make 7x7 position matrix)
-        p : feature map (base)
-        size : cropped position in original image space (base)
-        """
-        x, y, w, h = p
-        
-        matrix = torch.zeros((size, size, 2))
-        matrix[:, :, 1] = torch.stack([torch.linspace(x, x+w, size)]*size, 0)
-        matrix[:, :, 0] = torch.stack([torch.linspace(y, y+h, size)]*size, 1)
-        return matrix
-    
-    def _get_intersection_rect(self, p1, p2):
-        """
-        Get intersection rect
-        p1 : base rect
-        p2 : moment rect
-        """
-        x1, y1, w1, h1 = p1
-        x2, y2, w2, h2 = p2
-        
-        x1_c, y1_c = x1+w1/2, y1+h1/2
-        x2_c, y2_c = x2+w2/2, y2+h2/2
-
-        has_intersection = abs((x1_c - x2_c)*2 < (w1+w2)) and abs((y1_c - y2_c)*2 < (h1+h2))
+        sample1, x1, y1, w1, h1 = self._crop(sample)
+        sample1, is_flip1 = self._flip(sample1)
+        sample1 = fast_normalize(self.transform(image=sample1)['image'])
 
-        if has_intersection:
-            xA = max(x1, x2)
-            yA = max(y1, y2)
-            xB = min(x1+w1, x2+w2)
-            yB = min(y1+h1, y2+h2)
-            return torch.FloatTensor(np.array([min(xA, xB), min(yA, yB), max(xA, xB), max(yA, yB)]))
-        else:
-            return torch.FloatTensor(np.array([0, 0, 0, 0]))
-
-    def _get_intersection_mask(self, p, inter_rect):
-        """
-        Get intersection mask
-        p : position matrix
-        inter_rect : intersection rect's position
-        """
-        
-        inter_mask = torch.where((p[:,:,0] >= iy1) & (p[:,:,0] <= iy2) 
-                                    & (p[:,:,1] >= ix1) & (p[:,:,1] <=ix2), 1., 0.)
-        return torch.flatten(inter_mask)
-
-    def _get_A_matrix(self, base, moment, point):
-        """
-        Get A matrix
-        base : base coordinates
-        moment : moment coordinates
-        point : base rect's position (x, y, w, h)
-        """
-        x1, y1, w1, h1 = point
-        
-        diag_len = (torch.sqrt((w1.float()**2) + (h1.float()**2)))/7
-        
-        A_matrix = self._get_normalized_distance(base, moment, diag_len)
-        return A_matrix
-    
-    def _get_normalized_distance(self, base, moment, diaglen):
-        """
-        Get normalized distance
-        base : base coordinates
-        moment : moment coordinates
-        diaglen : base rect's diangonal length for normalization
-        """
-        size = base.shape[0]*base.shape[1]
-
-        base_x_matrix = base[:,:,1]
-        base_y_matrix = base[:,:,0]
-        
-        moment_x_matrix = moment[:,:,1]
-        moment_y_matrix = moment[:,:,0]
-        
-        # to compute the pairwise distance
-        dist_x_matrix = torch.mm(base_x_matrix.view(-1,1), torch.ones((1,size))) - torch.mm(torch.ones((size,1)), moment_x_matrix.view(1,-1))
-        dist_y_matrix = torch.mm(base_y_matrix.view(-1,1), torch.ones((1,size))) - torch.mm(torch.ones((size,1)), moment_y_matrix.view(1,-1))
+        sample2, x2, y2, w2, h2 = self._crop(sample)
+        sample2, is_flip2 = self._flip(sample2)
+        sample2 = fast_normalize(self.transform(image=sample2)['image'])
         
-        dist_matrix = torch.sqrt(dist_x_matrix**2 + dist_y_matrix**2) / (diaglen/7)
-        A_matrix = torch.zeros((dist_matrix.shape))
-        A_matrix[dist_matrix < self.args.threshold] = 1.
-        A_matrix[dist_matrix >= self.args.threshold] = 0.
+        # A matrix (and intersection mask) are built on the GPU from these, see compute_A_batch
+        params1 = torch.FloatTensor([x1, y1, w1, h1, is_flip1])
+        params2 = torch.FloatTensor([x2, y2, w2, h2, is_flip2])
         
-        return A_matrix
+        return PixProBatch(sample1, sample2, params1, params2)
     
     def __len__(self):
-        return len(self.samples)
+        return len(self.targets)
 
 #### For test
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--threshold', type=float, default=0.7)
+    parser.add_argument('--cache_dir', type=str, default='cache')
     args = parser.parse_args()
 
     dataset = PixProDataset(root='/workspace/datasets/8_challenges/ILSVRC/Data/CLS-LOC/train', args=args)
     from torch.utils.data import DataLoader
     dataloader = DataLoader(dataset, batch_size=1)
 
-    for (i1,i2), (m1, m2), irect in dataloader:
-        print(irect)
+    for batch in dataloader:
+        print(compute_A_batch(batch.params1, batch.params2, args.threshold).shape)
         print('debug')
         raise
 
@@ -38,7 +38,7 @@ class PixproLoss(nn.Module):
         """
         cos_sim = get_cosine_similarity(base, moment)
         
-        A_matrix = A_matrix.type(torch.BoolTensor).cuda()
+        A_matrix = A_matrix.bool()
         return cos_sim.masked_select(A_matrix).mean()
 
 
@@ -56,7 +56,7 @@ class PixContrastLoss(nn.Module):
         """
         cos_sim = get_cosine_similarity(base, moment)
         A_matrix *= inter_mask.unsqueeze(-1)
-        A_matrix = A_matrix.type(torch.BoolTensor).cuda()
+        A_matrix = A_matrix.bool()
 
         pos = cos_sim.masked_select(A_matrix) / self.args.T
         neg = cos_sim.masked_select(~A_matrix) / self.args.T
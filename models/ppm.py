@@ -17,10 +17,10 @@ class PixelPropagationModule(nn.Module):
         """
         b, c, h, w = x.shape
         
-        x_1 = x.view(b, c, h, w, 1, 1)
-        x_2 = x.view(b, c, 1, 1, h, w)
-        cos = F.cosine_similarity(x_1, x_2, dim=1) # B * HW * HW
-        s = torch.pow(F.relu(cos), self.sharpness)
+        # normalize along channels, then one bmm gives every pairwise cosine
+        x_n = F.normalize(x.view(b, c, h*w), dim=1)
+        cos = torch.bmm(x_n.transpose(1, 2), x_n) # B * HW * HW
+        s = torch.pow(cos.clamp(min=0), self.sharpness)
         return s
 
     def _make_transform_block(self, num_linear):
@@ -44,7 +44,10 @@ class PixelPropagationModule(nn.Module):
         vec_sim = self._compute_similarity(x) # B * HW * HW
         
         tr_x = self.transform_block(x)        # B * C * H * W
-        y = torch.einsum('bijhw, bchw -> bcij', vec_sim, tr_x)
+        
+        # y[b, c, i] = sum_j tr_x[b, c, j] * vec_sim[b, i, j]
+        y = torch.bmm(tr_x.view(b, c, h*w), vec_sim.transpose(1, 2))
+        y = y.view(b, c, h, w)
         
         return y
 
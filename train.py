@@ -6,10 +6,10 @@ import math
 from datetime import datetime
 
 from config import parse_arguments
-from datasets import PixProDataset
+from datasets import PixProDataset, compute_A_batch, compute_inter_mask_batch, worker_init_fn
 from models.resnet import resnet50
 from models.pixpro import PixPro
-from utils import AverageMeter, ProgressMeter
+from utils import AverageMeter, ProgressMeter, CUDAPrefetcher
 from losses import PixproLoss, PixContrastLoss
 from tensorboardX import SummaryWriter
 from torchlars import LARS
@@ -85,6 +85,8 @@ def main_worker(gpu, ngpus_per_node, args):
                 sharpness = args.sharpness ,
                 num_linear = args.num_linear,
                 )
+    # NHWC lets cuDNN pick its Tensor Core conv kernels
+    model = model.to(memory_format=torch.channels_last)
 
     args.lr = args.lr_base * args.batch_size/256
     
@@ -110,8 +112,16 @@ def main_worker(gpu, ngpus_per_node, args):
     else:
         raise NotImplementedError('only DDP is supported.')
 
+    if args.compile:
+        # only the PPM: PixPro.forward mutates python-side momentum state on every call,
+        # which would keep invalidating a whole-model graph.
+        # patching forward keeps the state_dict keys unchanged for checkpoints.
+        ppm = model.module.ppm if args.distributed else model.ppm
+        ppm.forward = torch.compile(ppm.forward, mode='max-autotune', fullgraph=False, dynamic=False)
+
     base_optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     optimizer = LARS(optimizer=base_optimizer, eps=1e-8)
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp)
     writer = SummaryWriter(args.log_dir) 
     if args.resume:
         checkpoint = torch.load(args.resume)
@@ -119,8 +129,14 @@ def main_worker(gpu, ngpus_per_node, args):
 
         model.load_state_dict(checkpoint['state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer'])
+        # a disabled GradScaler saves an empty state, which an enabled one refuses to load
+        if args.amp and checkpoint.get('scaler'):
+            scaler.load_state_dict(checkpoint['scaler'])
 
     cudnn.benchmark = True
+    # TF32 Tensor Core kernels for fp32 convs / matmuls on Ampere+
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 
     dataset = PixProDataset(root=args.train_path, args=args)
     
@@ -129,15 +145,19 @@ def main_worker(gpu, ngpus_per_node, args):
     else:
         train_sampler = None
     
+    # keep the workers alive across epochs instead of re-forking them every epoch.
+    # both options are only valid with worker processes, so leave them out otherwise
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=2) if args.workers > 0 else {}
     loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
-                    num_workers=args.workers, pin_memory=True, sampler=train_sampler, drop_last=True)
+                    num_workers=args.workers, pin_memory=True, sampler=train_sampler, drop_last=True,
+                    worker_init_fn=worker_init_fn, **worker_kwargs)
     
     for epoch in range(args.start_epoch, args.epochs):
         if args.distributed:
             train_sampler.set_epoch(epoch)
         
         adjust_lr(optimizer, epoch, args)
-        train(args, epoch, loader, model, optimizer, writer)
+        train(args, epoch, loader, model, optimizer, scaler, writer)
 
 
         if not args.multiprocessing_distributed or (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
@@ -147,10 +167,11 @@ def main_worker(gpu, ngpus_per_node, args):
                 'epoch': epoch + 1,
                 'state_dict': model.state_dict(),
                 'optimizer' : optimizer.state_dict(),
+                'scaler' : scaler.state_dict(),
                 }, save_name)
 
 
-def train(args, epoch, loader, model, optimizer, writer):
+def train(args, epoch, loader, model, optimizer, scaler, writer):
     model.train()
     batch_time = AverageMeter('Time', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
@@ -161,41 +182,57 @@ def train(args, epoch, loader, model, optimizer, writer):
         [lr, batch_time, losses],
         prefix='Epoch: [{}]'.format(epoch))
     
+    if args.loss == 'pixpro':
+        loss_fn = PixproLoss(args)
+    elif args.loss == 'pixcontrast':
+        loss_fn = PixContrastLoss(args)
+    else:
+        raise ValueError('HAVE TO SELECT PROPER LOSS TYPE')
+    
     end = time.time()
 
-    for _iter, (images, targets) in enumerate(loader):
-        images[0], images[1] = images[0].cuda(args.gpu, non_blocking=True), images[1].cuda(args.gpu, non_blocking=True)
+    # batches arrive already on the GPU, copied on a side stream
+    for _iter, batch in enumerate(CUDAPrefetcher(loader, args.gpu)):
+        images = [batch.img1.contiguous(memory_format=torch.channels_last), batch.img2.contiguous(memory_format=torch.channels_last)]
+        params_base, params_moment = batch.params1, batch.params2
         
-        # swap the image
-        yi, xj_moment = model(images[0], images[1])
-        yj, xi_moment = model(images[1], images[0])
-
-        if args.loss == 'pixpro':         
-            base_A_matrix, moment_A_matrix = targets[0].cuda(args.gpu), targets[1].cuda(args.gpu)
-            pixpro_loss = PixproLoss(args)
-            overall_loss = pixpro_loss(yi, xj_moment, base_A_matrix) + pixpro_loss(yj, xi_moment, moment_A_matrix)
+        # Get normalized distance matrix (positive, negative pair)
+        base_A_matrix = compute_A_batch(params_base, params_moment, args.threshold)
+        moment_A_matrix = compute_A_batch(params_moment, params_base, args.threshold)
         
-        elif args.loss == 'pixcontrast':
-            base_A_matrix, moment_A_matrix = targets[0][0].cuda(args.gpu), targets[0][1].cuda(args.gpu)
-            base_inter_mask, moment_inter_mask = targets[1][0].cuda(args.gpu), targets[1][1].cuda(args.gpu)
-
-            pixcontrast_loss = PixContrastLoss(args)
-            overall_loss = (pixcontrast_loss(yi, xj_moment, base_A_matrix, base_inter_mask) 
-                            + pixcontrast_loss(yj, xi_moment, moment_A_matrix, moment_inter_mask)) / 2
+        if args.loss == 'pixcontrast':
+            base_inter_mask, moment_inter_mask = compute_inter_mask_batch(params_base, params_moment)
+            base_pos, moment_pos = base_A_matrix * base_inter_mask.unsqueeze(-1), moment_A_matrix * moment_inter_mask.unsqueeze(-1)
         else:
-            ValueError('HAVE TO SELECT PROPER LOSS TYPE')
+            base_pos, moment_pos = base_A_matrix, moment_A_matrix
         
-        # if there is no intersection, skip the update
-        if torch.max(base_A_matrix) < 1 and torch.max(moment_A_matrix) < 1:
+        # if there is no intersection, skip the update (before spending the forward / backward on it)
+        has_intersection = (base_pos.amax() >= 1) | (moment_pos.amax() >= 1)
+        if not has_intersection.item():
             continue
+        
+        with torch.cuda.amp.autocast(enabled=args.amp):
+            # swap the image
+            yi, xj_moment = model(images[0], images[1])
+            yj, xi_moment = model(images[1], images[0])
+
+            if args.loss == 'pixpro':         
+                overall_loss = loss_fn(yi, xj_moment, base_A_matrix) + loss_fn(yj, xi_moment, moment_A_matrix)
+        
+            else:
+                overall_loss = (loss_fn(yi, xj_moment, base_A_matrix, base_inter_mask) 
+                                + loss_fn(yj, xi_moment, moment_A_matrix, moment_inter_mask)) / 2
 
         losses.update(overall_loss.item(), images[0].size(0))
         for param_group in optimizer.param_groups:
             cur_lr = param_group['lr']
         lr.update(cur_lr) 
-        optimizer.zero_grad()
-        overall_loss.backward()
-        optimizer.step()
+        # torchlars' LARS.zero_grad takes no arguments, so clear the grads on the model
+        model.zero_grad(set_to_none=True)
+        # LARS computes its trust ratio from the grads, scaler.step unscales them first
+        scaler.scale(overall_loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         
         batch_time.update(time.time() - end)
         end = time.time()
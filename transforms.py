@@ -4,36 +4,30 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-import torchvision.transforms as transforms
+import albumentations as A
+import cv2
 import random
 import math
 
-from abc import ABC, abstractmethod
-from PIL import Image, ImageOps, ImageFilter
+from PIL import Image
 
+# ImageNet statistics folded into a single scale / shift on the raw uint8 values
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+inv255_std = (1.0 / (255.0 * IMAGENET_STD)).reshape(1, 1, 3)
+mean_over_std = (IMAGENET_MEAN / IMAGENET_STD).reshape(1, 1, 3)
 
-class BaseTransform(ABC):
-    def __init__(self, prob, mag):
-        self.prob = prob
-        self.mag = mag
 
-    def __call__(self, img):
-        return transforms.RandomApply([self.transform], self.prob)(img)
-
-    @abstractmethod
-    def transform(self, img):
-        pass
-
-class Solarize(BaseTransform):
-    def transform(self, img):
-        thres = (1-self.mag) * 255
-        return ImageOps.solarize(img, thres)
+def fast_normalize(img):
+    """
+    uint8 (H, W, 3) array -> normalized float32 (3, H, W) tensor
+    same as ToTensor + Normalize, but in one pass over the image
+    """
+    x = img.astype(np.float32)
+    x *= inv255_std
+    x -= mean_over_std
+    return torch.from_numpy(x.transpose(2, 0, 1))
 
-class GaussianBlur(BaseTransform):
-    def transform(self, img):
-        kernel_size = self.mag
-        gBlur = ImageFilter.GaussianBlur(kernel_size)
-        return img.filter(gBlur)
 
 class RandomHorizontalFlip(object):
     def __init__(self, p=0.5):
@@ -41,13 +35,13 @@ class RandomHorizontalFlip(object):
 
     def __call__(self, img):
         is_flip = 0
-        if torch.rand(1) < self.p:
+        if random.random() < self.p:
             is_flip=1
-            return img.transpose(method=Image.FLIP_LEFT_RIGHT), is_flip
+            return cv2.flip(img, 1), is_flip
         return img, is_flip
 
 class RandomResizedCrop(object):
-    def __init__(self, size, scale=(0.08, 1.0), ratio=(3./4., 4./3.), interpolation=Image.BILINEAR):
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3./4., 4./3.), interpolation=cv2.INTER_LINEAR):
         if isinstance(size, (tuple, list)):
             self.size = size
         else:
@@ -59,12 +53,12 @@ class RandomResizedCrop(object):
 
     @staticmethod
     def get_params(img, scale, ratio):
-        width, height = img.size
+        height, width = img.shape[:2]
         area = width * height
+        log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
 
         for _ in range(10):
             target_area = random.uniform(*scale) *area
-            log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
             aspect_ratio = math.exp(random.uniform(*log_ratio))
 
             w = int(round(math.sqrt(target_area * aspect_ratio)))
@@ -91,21 +85,20 @@ class RandomResizedCrop(object):
 
     def __call__(self, img):
         i, j, h, w = self.get_params(img, self.scale, self.ratio)
-        img = img.crop((j, i, j+w, i+h))
-        img = img.resize(self.size)
+        img = img[i:i+h, j:j+w]
+        # cv2 takes the output size as (width, height)
+        img = cv2.resize(img, (self.size[1], self.size[0]), interpolation=self.interpolation)
         return img, j, i, w, h 
 
 ### TEST
 if __name__ == '__main__':
-    img = Image.open('testimg.png')
-    np_img = np.asarray(img)
-    pil_img = Image.fromarray(np_img)
+    img = cv2.cvtColor(cv2.imread('testimg.png', cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
     transform = RandomResizedCrop((224,224))
    
-    img, x, y, w, h = transform(pil_img)
-    img.save('crop_resized.png')
+    img, x, y, w, h = transform(img)
+    Image.fromarray(img).save('crop_resized.png')
     img, is_flip = RandomHorizontalFlip(1.0)(img)
-    img.save('flip.png')
+    Image.fromarray(img).save('flip.png')
     
     #pil_img.save('pil_img.png')
     #transformed_img.save('tr_img.png')
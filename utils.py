@@ -1,3 +1,5 @@
+import torch
+
 class AverageMeter(object):
     def __init__(self, name, fmt=':f'):
         self.name = name
@@ -38,6 +40,49 @@ class ProgressMeter(object):
         return '[' + fmt + '/' + fmt.format(num_batches) + ']'
 
 
+class CUDAPrefetcher(object):
+    """
+    Wraps a DataLoader and copies the next batch to the GPU on a side stream,
+    so the H2D copy overlaps with the current step.
+    Batches are namedtuples of tensors (see datasets.PixProBatch).
+    """
+    def __init__(self, loader, device=None):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_batch = type(batch)(*(t.cuda(self.device, non_blocking=True) for t in batch))
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.next_batch
+        # allocated on the side stream but used on the main one
+        for t in batch:
+            t.record_stream(torch.cuda.current_stream())
+
+        self._preload()
+        return batch
+
+
 ##### FOR VISUAL DEBUGGING !!!
 import numpy as np
 import torchvision